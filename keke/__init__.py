@@ -11,24 +11,32 @@ try:
 except ImportError:  # pragma: no cover
     __version__ = "dev"
 
+import codecs
 import gc
+import io
 import json
 import os
+import re
+import sys
 import threading
 import time
-from contextlib import contextmanager
-from functools import wraps
-from inspect import signature
-from queue import SimpleQueue
+from collections import deque
+from functools import lru_cache, wraps
+from inspect import Parameter, Signature, signature
+from math import isfinite
 from typing import (
     Any,
+    BinaryIO,
     Callable,
     cast,
+    Deque,
     Dict,
-    Generator,
     IO,
+    List,
     Optional,
+    Sequence,
     Set,
+    Tuple,
     TypeVar,
     Union,
 )
@@ -36,6 +44,190 @@ from typing import (
 TRACER: "Optional[TraceOutput]" = None
 F = TypeVar("F", bound=Callable[..., Any])
 
+# Compact form of the common events, which the writer thread (rather than the
+# traced one) turns into JSON.  The ts and dur are in raw clock units.
+# (name, cat, ph, ts, dur, (tid, thread), args)
+ThreadInfo = Tuple[int, threading.Thread]
+RawEvent = Tuple[str, str, str, float, float, ThreadInfo, Dict[str, Any]]
+
+# The writer thread collects up to this many events before doing a single
+# write, and waits for the delay (in seconds) whenever it finds the queue empty.
+WRITER_BATCH_SIZE = 1024
+WRITER_BATCH_DELAY = 0.01
+
+# Real files get written through a buffer this large (rather than the default
+# 8KB) so that those batches reach the OS in as few writes as possible.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Event args are passed through from the caller untouched; anything that isn't
+# natively serializable gets its str() taken here, on the writer thread.
+_stdlib_dumps: Callable[[Any], str] = json.JSONEncoder(
+    separators=(",", ":"), default=str
+).encode
+_dumps = _stdlib_dumps
+
+try:
+    # Optional, but several times faster at serializing events in the writer.
+    import orjson
+except ImportError:  # pragma: no cover
+    pass
+else:
+
+    # orjson natively serializes some types that the stdlib would take the
+    # str() of; these options make those match.  Enums (their value rather
+    # than str()) and float subclasses (str() rather than the float) still
+    # differ.
+    _ORJSON_OPTIONS = (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+    def _orjson_dumps(obj: Any) -> str:
+        try:
+            return orjson.dumps(obj, default=str, option=_ORJSON_OPTIONS).decode()
+        except orjson.JSONEncodeError:
+            # e.g. ints wider than 64 bits, which the stdlib handles fine.
+            return _stdlib_dumps(obj)
+
+    _dumps = _orjson_dumps
+
+
+if hasattr(threading, "get_native_id"):
+    _get_tid = threading.get_native_id
+else:  # pragma: no cover
+    _get_tid = threading.get_ident
+
+_tls = threading.local()
+
+
+def _thread_info() -> ThreadInfo:
+    """
+    Returns (tid, thread object) for the current thread, looking them up only
+    the first time a given thread asks.  The name is read from the thread when
+    needed, since it can change.
+    """
+    try:
+        return cast(ThreadInfo, _tls.info)
+    except AttributeError:
+        info = _tls.info = (_get_tid(), threading.current_thread())
+        return info
+
+
+def _reset_thread_info() -> None:
+    # The thread that forked keeps its thread-locals in the child, but not its
+    # tid.
+    global _tls
+    _tls = threading.local()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_thread_info)
+
+
+# Printable ASCII other than backslash and double quote, which can go into a
+# JSON string unescaped.
+_JSON_SAFE = re.compile(r"[ !#-\[\]-~]*")
+
+
+# The same few names and categories tend to make up most events, so this is
+# memoized, which is several times faster than even the fast path below.
+@lru_cache(maxsize=4096)
+def _json_str(s: str) -> str:
+    # Names and categories should be str, but anything else gets serialized.
+    if type(s) is str and _JSON_SAFE.fullmatch(s):
+        return f'"{s}"'
+    return _dumps(s)
+
+
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+
+def _escape_char(m: "re.Match[str]") -> str:
+    c = ord(m.group())
+    if c > 0xFFFF:
+        c -= 0x10000
+        return f"\\u{0xD800 | (c >> 10):04x}\\u{0xDC00 | (c & 0x3FF):04x}"
+    return f"\\u{c:04x}"
+
+
+def _ensure_ascii(text: str) -> str:
+    """
+    Escapes any non-ASCII characters in serialized JSON text (where they can
+    only be inside strings) the way json.dumps does by default.
+    """
+    if text.isascii():
+        return text
+    return _NON_ASCII.sub(_escape_char, text)
+
+
+def _is_utf8(file: IO[Any]) -> bool:
+    encoding = getattr(file, "encoding", None)
+    return encoding is not None and codecs.lookup(encoding).name == "utf-8"
+
+
+def _text_output(file: IO[Any], binary: bool) -> IO[str]:
+    """
+    Returns what to write trace text to for `file`: a new text wrapper with a
+    larger buffer around the raw file that `file` writes to if there is one,
+    otherwise a UTF-8 wrapper if it's binary (e.g. BytesIO), otherwise `file`
+    itself (e.g. StringIO).
+    """
+    if binary:
+        buffer: Any = file
+        encoding: Optional[str] = "utf-8"
+        errors: Optional[str] = None
+    else:
+        buffer = getattr(file, "buffer", None)
+        encoding = getattr(file, "encoding", None)
+        errors = getattr(file, "errors", None)
+
+    if isinstance(buffer, (io.BufferedWriter, io.BufferedRandom)):
+        file.flush()
+        return io.TextIOWrapper(
+            io.BufferedWriter(buffer.raw, buffer_size=OUTPUT_BUFFER_SIZE),
+            encoding=encoding,
+            errors=errors,
+        )
+    elif binary:
+        return io.TextIOWrapper(cast(BinaryIO, file), encoding=encoding)
+    else:
+        return file
+
+
+def _thread_metadata(
+    pid: int, tid: int, name: str, sort_index: int
+) -> List[Dict[str, Any]]:
+    return [
+        {
+            "pid": pid,
+            "tid": tid,
+            "ts": 0,
+            "ph": "M",
+            "cat": "__metadata",
+            "name": "thread_name",
+            "args": {"name": name},
+        },
+        {
+            "pid": pid,
+            "tid": tid,
+            "ts": 9,
+            "ph": "M",
+            "cat": "__metadata",
+            "name": "thread_sort_index",
+            "args": {"sort_index": sort_index},
+        },
+    ]
+
+
+@lru_cache(maxsize=256)
+def _thread_metadata_json(pid: int, tid: int, name: str, sort_index: int) -> str:
+    """
+    The serialized form of _thread_metadata, which is the same every time a
+    thread shows up in a new trace (e.g. with many short TraceOutputs).
+    """
+    return ",\n".join(map(_dumps, _thread_metadata(pid, tid, name, sort_index)))
+
 
 def get_tracer() -> "Optional[TraceOutput]":
     t = TRACER
@@ -49,10 +241,15 @@ def to_microseconds(s: float) -> float:
     return s * 1_000_000
 
 
+def _ns_to_microseconds(ns: float) -> float:
+    # Chrome's trace format takes (possibly fractional) microseconds.
+    return ns / 1000
+
+
 class TraceOutput:
     def __init__(
         self,
-        file: IO[str],
+        file: Union[IO[str], IO[bytes]],
         # These sort key substrings are neat and work in chrome://tracing but
         # notably do _not_ work in perfetto when using json input.
         # https://groups.google.com/g/perfetto-dev/c/zOe_Y2FxGGk
@@ -65,26 +262,61 @@ class TraceOutput:
         pid: Optional[int] = None,
         clock: Optional[Callable[[], float]] = None,
         close_output_file: Optional[bool] = True,
+        queue_size: Optional[int] = None,
+        gc_events: bool = True,
     ) -> None:
+        self._binary = False
         if file is not None:
-            # Ensure we get an early, main-thread error if opened in binary mode or
-            # not for writing.
-            file.write("")  # if this raises, check your file mode
-
-        self.output = file
+            # Ensure we get an early, main-thread error if not opened for
+            # writing.  Binary mode is fine; we'll write UTF-8.
+            try:
+                cast(IO[str], file).write("")
+            except TypeError:
+                cast(IO[bytes], file).write(b"")  # if this raises, check your file mode
+                self._binary = True
+
+        self.output: IO[Any] = file
         self.close_output_file = close_output_file
-        self.queue: "SimpleQueue[Optional[Dict[Any, Any]]]" = SimpleQueue()
+        # Producers never block; if a queue_size is given and the writer falls
+        # behind by more than that many events, new ones are counted in
+        # dropped_events instead (and that count is written at the end).
+        self.queue: "Deque[Union[None, Dict[str, Any], RawEvent]]" = deque()
+        self.queue_size = queue_size
+        self._queue_limit = sys.maxsize if queue_size is None else queue_size
+        self.dropped_events = 0
+        # Set alongside queueing the shutdown sentinel, to cut short the
+        # writer's idle wait rather than leave __exit__ waiting on it.
+        self._stopping = threading.Event()
 
         # There are two good reasons for overriding the pid value -- one is in
         # distributed systems, where the pid might get reused (or even reused
         # across machines; the other is for testing).  When in doubt, you can
         # always post-process to change the pid value.
         self.pid = pid or os.getpid()
-        self.clock = clock or time.monotonic
+        # The public clock returns seconds, but internally we use the integer
+        # nanoseconds of perf_counter_ns unless given one.  Either way, the raw
+        # clock values are what go into the queue for the writer to convert.
+        if clock is None:
+            self.clock: Callable[[], float] = time.perf_counter
+            self._raw_clock: Callable[[], float] = time.perf_counter_ns
+            self._raw_to_microseconds: Callable[[float], float] = _ns_to_microseconds
+        else:
+            self.clock = clock
+            self._raw_clock = clock
+            self._raw_to_microseconds = to_microseconds
         self.enabled = False
 
-        self._thread_sortkeys = thread_sortkeys
+        # A single search finds the sort key for a thread name.  The
+        # alternatives are reversed so that when two keys match at the same
+        # spot, the later one wins.
+        self._thread_sort_values = list(thread_sortkeys.values())
+        groups = [f"(?P<k{i}>{re.escape(k)})" for i, k in enumerate(thread_sortkeys)]
+        self._thread_sort_re = re.compile("|".join(reversed(groups)))
         self._thread_name_output: Set[int] = set()
+        # Whether to record garbage collections (on a fake thread); this is the
+        # only tracing that costs anything outside of explicit kev/ktrace/etc.
+        self.gc_events = gc_events
+        self._gc_start_by_gen: Dict[int, float] = {}
 
     def with_tid(
         self, obj: Dict[str, Any], id: Optional[int] = None, name: Optional[str] = None
@@ -95,65 +327,73 @@ class TraceOutput:
         intended for synthetic threads, like having GC appear as its own.
         """
         if id is None:
-            if hasattr(threading, "get_native_id"):
-                id = threading.get_native_id()
-            else:
-                id = threading.get_ident()
+            id, thread = _thread_info()
+            if name is None:
+                name = thread.name
         obj["tid"] = id
 
         if id not in self._thread_name_output:
             self._thread_name_output.add(id)
-            n = 0  # TODO rethink?
             if name is None:
                 name = threading.current_thread().name
-            for k, v in self._thread_sortkeys.items():
-                if k in name:
-                    n = v
-            self.queue.put(
-                {
-                    "pid": self.pid,
-                    "tid": id,
-                    "ts": 0,
-                    "ph": "M",
-                    "cat": "__metadata",
-                    "name": "thread_name",
-                    "args": {"name": name},
-                }
-            )
-            self.queue.put(
-                {
-                    "pid": self.pid,
-                    "tid": id,
-                    "ts": 9,
-                    "ph": "M",
-                    "cat": "__metadata",
-                    "name": "thread_sort_index",
-                    "args": {"sort_index": n},
-                }
-            )
+            sort_index = self._thread_sort_index(name)
+            for meta in _thread_metadata(self.pid, id, name, sort_index):
+                self.put_raw(meta)
         return obj
 
+    def _thread_sort_index(self, name: str) -> int:
+        n = 0  # TODO rethink?
+        m = self._thread_sort_re.search(name)
+        if m is not None and m.lastgroup is not None:
+            n = self._thread_sort_values[int(m.lastgroup[1:])]
+        return n
+
     def __enter__(self) -> None:
         if self.output is None:
             return self
+        self._file = self.output
+        self.output = _text_output(self._file, self._binary)
+        # Anything else (including StringIO, which has no encoding) gets the
+        # same ASCII-only output as the stdlib json would give it.
+        self._ascii_only = not _is_utf8(self.output)
         self.output.write("[\n")
+        # Left set by any previous __exit__, when the same instance is reused.
+        self._stopping.clear()
         self._writer = threading.Thread(target=self.writer)
         self._writer.start()
         self.enabled = True
         global TRACER
         TRACER = self
-        gc.callbacks.append(self._gc_callback)
+        if self.gc_events:
+            gc.callbacks.append(self._gc_callback)
 
     def __exit__(self, *unused_args: Any) -> None:
         if self.output is None:
             return
-        gc.callbacks.remove(self._gc_callback)
+        if self.gc_events:
+            gc.callbacks.remove(self._gc_callback)
         self.enabled = False
         global TRACER
         TRACER = None
-        self.queue.put(None)
+        self.queue.append(None)  # Cheap shutdown sentinel, never dropped
+        self._stopping.set()
         self._writer.join()
+        if self.dropped_events:
+            dropped = {
+                "pid": self.pid,
+                "ts": self._raw_to_microseconds(self._raw_clock()),
+                "ph": "C",
+                "name": "dropped_events",
+                "args": {"value": self.dropped_events},
+            }
+            self.output.write(_dumps(dropped) + ",\n")
         self.output.write("{}]\n")
+        if self.output is not self._file:
+            # Flushes, but leaves the underlying file open for _file to close.
+            buffer = cast(io.TextIOWrapper, self.output).detach()
+            if buffer is not self._file:
+                cast(io.BufferedWriter, buffer).detach()
+            self.output = self._file
         if self.close_output_file:
             # prevents accidental reuse that produces invalid json, but you can
             # disable if it's e.g. a StringIO that you want to read back
@@ -163,41 +403,154 @@ class TraceOutput:
         # TODO We'd like to use begin/end async events, but those don't appear
         # to be recognized in Perfetto, rather unaopologeticly
         # https://github.com/google/perfetto/issues/60
-        ts = to_microseconds(self.clock())
+        ts = self._raw_to_microseconds(self._raw_clock())
         if phase == "start":
-            self._gc_start = ts
+            self._gc_start_by_gen[info.get("generation", 0)] = ts
         else:
+            start = self._gc_start_by_gen.pop(info.get("generation", 0), None)
+            if start is None:
+                # Started before we were enabled.
+                return
             # Ideally this would be recorded as an async event, but that doesn't
             # appear to work in Perfetto so we invent a fake thread.
-            self.put(
+            self.put_raw(
                 {
+                    "pid": self.pid,
                     "cat": "gc",
                     "name": "collect",
                     "ph": "X",
                     "tid": 0,
-                    "ts": self._gc_start,
-                    "dur": ts - self._gc_start,
+                    "ts": start,
+                    "dur": ts - start,
                     "args": info,
-                },
-                False,
+                }
             )
 
     def writer(self) -> None:
-        while True:
-            item = self.queue.get()
-            if item is None:  # Cheap shutdown sentinel
-                break
-            # TODO no whitespace inside
-            self.output.write(json.dumps(item, separators=(",", ":")) + ",\n")
+        # Everything used per event is bound to a local up front.
+        popleft = self.queue.popleft
+        write = self.output.write
+        format_raw = self._format
+        dumps = _dumps
+        ascii_only = self._ascii_only
+        done = False
+        while not done:
+            batch: List[str] = []
+            append = batch.append
+            idle = False
+            try:
+                while len(batch) < WRITER_BATCH_SIZE:
+                    item = popleft()
+                    if item is None:
+                        done = True
+                        break
+                    try:
+                        if isinstance(item, tuple):
+                            append(format_raw(item, batch))
+                        else:
+                            append(dumps(item))
+                    except Exception as e:
+                        # One bad arg shouldn't cost the rest of the trace.
+                        append(self._format_error(item, e))
+            except IndexError:
+                idle = True
+
+            if batch:
+                text = ",\n".join(batch) + ",\n"
+                write(_ensure_ascii(text) if ascii_only else text)
+            if idle:
+                self._stopping.wait(WRITER_BATCH_DELAY)
+
+    def _format(self, item: RawEvent, batch: List[str]) -> str:
+        """
+        Serializes a RawEvent directly from a template (the schema being fixed,
+        only the strings and args need escaping), first appending thread name
+        metadata to `batch` if this is the first we've seen of that thread.
+        """
+        name, cat, ph, ts, dur, (tid, thread), args = item
+        to_microseconds = self._raw_to_microseconds
+        ts = to_microseconds(ts)
+        dur = to_microseconds(dur)
+        ts_json: Union[float, str] = ts
+        dur_json: Union[float, str] = dur
+        if not (isfinite(ts) and isfinite(dur)):
+            # Formatted directly, these would be a bare nan or inf.
+            ts_json = _dumps(ts)
+            dur_json = _dumps(dur)
+        seen = self._thread_name_output
+        if tid not in seen:
+            seen.add(tid)
+            thread_name = thread.name
+            sort_index = self._thread_sort_index(thread_name)
+            batch.append(_thread_metadata_json(self.pid, tid, thread_name, sort_index))
+        return (
+            f'{{"pid":{self.pid},"tid":{tid},"ts":{ts_json},"ph":"{ph}",'
+            f'"cat":{_json_str(cat)},"name":{_json_str(name)},"dur":{dur_json},'
+            f'"args":{_dumps(args) if args else "{}"}}}'
+        )
+
+    def _format_error(
+        self, item: Union[Dict[str, Any], RawEvent], exc: Exception
+    ) -> str:
+        """
+        Serializes an event that failed to, with the exception in place of
+        its args.
+        """
+        if isinstance(item, tuple):
+            name, cat, ph, ts, dur, (tid, _), _ = item
+            obj = {
+                "pid": self.pid,
+                "tid": tid,
+                "ts": self._raw_to_microseconds(ts),
+                "ph": ph,
+                "cat": cat,
+                "name": name,
+                "dur": self._raw_to_microseconds(dur),
+            }
+        else:
+            obj = {k: v for k, v in item.items() if k != "args"}
+        obj["args"] = {"error": repr(exc)}
+        return _stdlib_dumps(obj)
+
+    def put_raw(self, obj: Union[Dict[str, Any], RawEvent]) -> None:
+        """
+        Enqueues an event as-is; the caller is responsible for it being
+        complete (a dict with pid, ts, and if needed tid), or a RawEvent.
+        """
+        # deque.append is atomic, so the only cost to producers is this length
+        # check; the dropped count is best-effort under contention.
+        queue = self.queue
+        if len(queue) < self._queue_limit:
+            queue.append(obj)
+        else:
+            self.dropped_events += 1
+
+    def put_timed(self, obj: Dict[str, Any], with_tid: bool) -> None:
+        """
+        Like put(), but for events known to have neither pid nor ts yet.
+        """
+        obj["pid"] = self.pid
+        obj["ts"] = self._raw_to_microseconds(self._raw_clock())
+        if with_tid:
+            self.with_tid(obj)
+        self.put_raw(obj)
+
+    def emit_counter(self, name: str, args: Dict[str, int]) -> None:
+        self.put_timed({"ph": "C", "name": name, "args": args}, False)
+
+    def emit_instant(self, name: str, cat: str, scope: str) -> None:
+        self.put_timed(
+            {"ph": "i", "cat": cat, "name": name, "s": scope}, scope == Scope.THREAD
+        )
 
     def put(self, obj: Dict[str, Any], with_tid: bool) -> None:
         if "pid" not in obj:
             obj["pid"] = self.pid
         if "ts" not in obj:
-            obj["ts"] = to_microseconds(self.clock())
+            obj["ts"] = self._raw_to_microseconds(self._raw_clock())
         if with_tid:
             obj = self.with_tid(obj)
-        self.queue.put(obj)
+        self.put_raw(obj)
 
 
 def kcount(name: str, value: Optional[int] = None, **kwargs: int) -> None:
@@ -211,7 +564,7 @@ def kcount(name: str, value: Optional[int] = None, **kwargs: int) -> None:
 
     t = get_tracer()
     if t is not None:
-        t.put({"name": name, "ph": "C", "args": args}, False)
+        t.emit_counter(name, args)
 
 
 # TODO this is not a real enum
@@ -225,32 +578,124 @@ def kmark(name: str, cat: str = "mark", scope: str = Scope.THREAD) -> None:
     # TODO "stack" record
     t = get_tracer()
     if t is not None:
-        t.put({"name": name, "cat": cat, "ph": "i", "s": scope}, scope == Scope.THREAD)
+        t.emit_instant(name, cat, scope)
 
 
-@contextmanager
-def kev(name: str, cat: str = "dur", **kwargs: Any) -> Generator[None, None, None]:
-    enabled = False
-    t = get_tracer()
-    if t is not None:
-        enabled = True
-        t0 = to_microseconds(t.clock())
+class _Kev:
+    """
+    What kev returns.  Like the contextmanager it replaces, this only looks up
+    the tracer when entered (and also works as a decorator).
+    """
 
-    try:
-        yield
-    finally:
-        if enabled:
-            assert t is not None
-            t1 = to_microseconds(t.clock())
-            ev = {
-                "name": name,
-                "cat": cat,
-                "ph": "X",
-                "ts": t0,
-                "dur": t1 - t0,
-                "args": kwargs,
-            }
-            t.put(ev, True)
+    __slots__ = ("name", "cat", "args", "t", "t0")
+    t: Optional[TraceOutput]
+
+    def __init__(self, name: str, cat: str, args: Dict[str, Any]) -> None:
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self) -> None:
+        # This is get_tracer, inlined.
+        t = TRACER
+        if t is None or not t.enabled:
+            self.t = None
+        else:
+            self.t = t
+            self.t0 = t._raw_clock()
+
+    def __exit__(self, *unused_args: Any) -> None:
+        t = self.t
+        if t is None:
+            return
+        t0 = self.t0
+        t1 = t._raw_clock()
+        try:
+            info = _tls.info
+        except AttributeError:
+            info = _thread_info()
+        # This is put_raw, inlined.
+        queue = t.queue
+        if len(queue) < t._queue_limit:
+            queue.append((self.name, self.cat, "X", t0, t1 - t0, info, self.args))
+        else:
+            t.dropped_events += 1
+
+    def __call__(self, func: F) -> F:
+        name = self.name
+        cat = self.cat
+        args = self.args
+
+        @wraps(func)
+        def dec(*a: Any, **kw: Any) -> Any:
+            with _Kev(name, cat, args):
+                return func(*a, **kw)
+
+        return cast(F, dec)
+
+
+def kev(name: str, cat: str = "dur", **kwargs: Any) -> _Kev:
+    return _Kev(name, cat, kwargs)
+
+
+def _make_extractor(
+    sig: Signature, trace_args: Sequence[str]
+) -> Callable[..., Dict[str, str]]:
+    """
+    Generates a function taking the same parameters as `sig` that returns the
+    str() of each of `trace_args` evaluated against them (or the repr of the
+    exception doing so raised).  This does once, at decoration time, what would
+    otherwise be a `Signature.bind` and an `eval` per trace arg on every call.
+    """
+    ns: Dict[str, Any] = {"__keke_str": str, "__keke_repr": repr}
+    params = [
+        p.replace(default=Parameter.empty, annotation=Parameter.empty)
+        for p in sig.parameters.values()
+    ]
+    if sys.version_info < (3, 8):
+        # There's no syntax for positional-only params yet (which on these
+        # versions only builtins have), so accept them by name as well.
+        params = [
+            (
+                p.replace(kind=Parameter.POSITIONAL_OR_KEYWORD)
+                if p.kind is Parameter.POSITIONAL_ONLY
+                else p
+            )
+            for p in params
+        ]
+    bare_sig = sig.replace(parameters=params, return_annotation=Signature.empty)
+    lines = [f"def __keke_extract{bare_sig}:"]
+    items = []
+    for i, x in enumerate(trace_args):
+        v = f"__keke_v{i}"
+        try:
+            # Like eval() would, which is what these used to be passed to.
+            compile(x.lstrip(" \t"), "<string>", "eval")
+        except SyntaxError as e:
+            ns[v] = repr(e)
+        else:
+            # Being a single valid expression, this can't escape the parens.
+            lines.append("    try:")
+            lines.append(f"        {v} = __keke_str((\n{x}\n))")
+            lines.append("    except Exception as __keke_e:")
+            lines.append(f"        {v} = __keke_repr(__keke_e)")
+        items.append(f"{x!r}: {v}")
+    lines.append(f"    return {{{', '.join(items)}}}")
+
+    exec(compile("\n".join(lines), "<ktrace>", "exec"), ns)
+    extract = ns["__keke_extract"]
+    extract.__defaults__ = tuple(
+        p.default
+        for p in sig.parameters.values()
+        if p.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)
+        and p.default is not Parameter.empty
+    )
+    extract.__kwdefaults__ = {
+        p.name: p.default
+        for p in sig.parameters.values()
+        if p.kind is Parameter.KEYWORD_ONLY and p.default is not Parameter.empty
+    }
+    return cast(Callable[..., Dict[str, str]], extract)
 
 
 def ktrace(*trace_args: str, shortname: Union[str, bool] = False) -> Callable[[F], F]:
@@ -260,7 +705,10 @@ def ktrace(*trace_args: str, shortname: Union[str, bool] = False) -> Callable[[F
         )
 
     def inner(func: F) -> F:
-        sig = signature(func)
+        # Only needed to evaluate trace_args, which not every use has.
+        extract = None
+        if trace_args:
+            extract = _make_extractor(signature(func), trace_args)
         if isinstance(shortname, str):
             name = shortname
         elif shortname:
@@ -270,21 +718,14 @@ def ktrace(*trace_args: str, shortname: Union[str, bool] = False) -> Callable[[F
 
         @wraps(func)
         def dec(*args: Any, **kwargs: Any) -> Any:
-            t = get_tracer()
-            if t is None:
+            # This is get_tracer, inlined.
+            t = TRACER
+            if t is None or not t.enabled:
                 return func(*args, **kwargs)
 
-            bound = sig.bind(*args, **kwargs)
-            bound.apply_defaults()
-
-            def safe_get(x: str) -> str:
-                try:
-                    return str(eval(x, bound.arguments, bound.arguments))
-                except Exception as e:
-                    return repr(e)
-
-            params = {k: safe_get(k) for k in trace_args}
-            with kev(name, **params):
+            params = extract(*args, **kwargs) if extract is not None else {}
+            # kev would copy params.
+            with _Kev(name, "dur", params):
                 return func(*args, **kwargs)
 
         return cast(F, dec)
@@ -1,16 +1,65 @@
+import dataclasses
+import datetime
+import gc
 import io
 import json
+import math
+import os
+import tempfile
+import threading
+import time
 import unittest
-from typing import Any
+from typing import Any, Dict, List
+from unittest.mock import patch
 
-from keke import kev, ktrace, TraceOutput
+import keke
+from keke import (
+    kcount,
+    kev,
+    kmark,
+    ktrace,
+    Scope,
+    to_microseconds as to_us,
+    TraceOutput,
+)
 
 
-class NonclosingStringIO(io.StringIO):
+@dataclasses.dataclass
+class DataclassArg:
+    x: int
+
+
+class DictSubclassArg(dict):  # type: ignore
+    pass
+
+
+# Args the stdlib json and orjson would serialize differently by default.
+ODD_ARGS = {
+    "dt": datetime.datetime(2024, 1, 2, 3, 4, 5),
+    "d": datetime.date(2024, 1, 2),
+    "dc": DataclassArg(1),
+    "sub": DictSubclassArg(a=1),
+}
+ODD_ARGS_JSON = {
+    "dt": "2024-01-02 03:04:05",
+    "d": "2024-01-02",
+    "dc": "DataclassArg(x=1)",
+    "sub": {"a": 1},
+}
+
+
+class NonclosingBytesIO(io.BytesIO):
     def close(self) -> None:
         pass
 
 
+def load_nongc(data: bytes) -> List[Dict[str, Any]]:
+    """
+    Parses trace output, leaving out the gc events that can show up anywhere.
+    """
+    return [ev for ev in json.loads(data) if ev.get("cat") != "gc"]
+
+
 class TraceOutputTest(unittest.TestCase):
     def test_basic(self) -> None:
         n = 123.0
@@ -18,9 +67,10 @@ class TraceOutputTest(unittest.TestCase):
         def clock() -> float:
             return float(n)
 
-        f = NonclosingStringIO()
+        f = NonclosingBytesIO()
 
-        with TraceOutput(file=f, pid=4, clock=clock):  # chosen by dice roll
+        # chosen by dice roll
+        with TraceOutput(file=f, pid=4, clock=clock, gc_events=False):
             with kev("name_here", "cat_here", arg=1):
                 n = 125.0
             with kev("name2_here", "cat_here"):
@@ -58,6 +108,227 @@ class TraceOutputTest(unittest.TestCase):
         # 4 = comma-on-a-line hack
         self.assertEqual({}, events[4])
 
+    def test_kcount_kmark(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            kcount("count_here", 5, other=6)
+            kmark("mark_here")
+            kmark("global_mark_here", "cat_here", Scope.GLOBAL)
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual(6, len(events))
+
+        self.assertEqual("count_here", events[0]["name"])
+        self.assertEqual("C", events[0]["ph"])
+        self.assertEqual(4, events[0]["pid"])
+        self.assertEqual(10_000_000, events[0]["ts"])
+        self.assertEqual({"value": 5, "other": 6}, events[0]["args"])
+
+        # 1, 2 = thread metadata for the thread-scoped mark
+        self.assertEqual("thread_name", events[1]["name"])
+        self.assertEqual("mark_here", events[3]["name"])
+        self.assertEqual("i", events[3]["ph"])
+        self.assertEqual("t", events[3]["s"])
+        self.assertEqual(events[1]["tid"], events[3]["tid"])
+
+        self.assertEqual("global_mark_here", events[4]["name"])
+        self.assertEqual("cat_here", events[4]["cat"])
+        self.assertEqual("g", events[4]["s"])
+        self.assertNotIn("tid", events[4])
+
+    def test_put(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            t = keke.get_tracer()
+            assert t is not None
+            t.put({"ph": "i", "name": "given", "pid": 5, "ts": 3, "s": "g"}, False)
+            t.put({"ph": "i", "name": "filled", "s": "t"}, True)
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual(5, len(events))
+        self.assertEqual("given", events[0]["name"])
+        self.assertEqual(5, events[0]["pid"])
+        self.assertEqual(3, events[0]["ts"])
+        self.assertNotIn("tid", events[0])
+
+        self.assertEqual("thread_name", events[1]["name"])
+        self.assertEqual("filled", events[3]["name"])
+        self.assertEqual(4, events[3]["pid"])
+        self.assertEqual(10_000_000, events[3]["ts"])
+        self.assertEqual(events[1]["tid"], events[3]["tid"])
+
+    def test_kev_args(self) -> None:
+        class Slow:
+            def __str__(self) -> str:
+                return "slow"
+
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            with kev("name_here", "cat_here", a=1, b=None, c="x", d=Slow()):
+                pass
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual({"a": 1, "b": None, "c": "x", "d": "slow"}, events[2]["args"])
+
+    def test_kev_escaping(self) -> None:
+        f = NonclosingBytesIO()
+        names = ["plain", 'quo"te', "back\\slash", "new\nline", "\x00", "caf\xe9"]
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            for name in names:
+                with kev(name, name):
+                    pass
+
+        events = [ev for ev in load_nongc(f.getvalue()) if ev.get("ph") == "X"]
+        self.assertEqual(names, [ev["name"] for ev in events])
+        self.assertEqual(names, [ev["cat"] for ev in events])
+
+    def test_thread_sortkeys(self) -> None:
+        f = NonclosingBytesIO()
+        names = ("PoolWorker-1", "Pool-1", "Other")
+        # Kept alive together, so no thread can reuse another's tid.
+        barrier = threading.Barrier(len(names))
+
+        def work() -> None:
+            with kev("name_here", "cat_here"):
+                pass
+            barrier.wait()
+
+        with TraceOutput(
+            file=f, thread_sortkeys={"Pool": 1, "PoolWorker": 2, "Main": 3}
+        ):
+            threads = [threading.Thread(target=work, name=name) for name in names]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+
+        events = json.loads(f.getvalue())
+        names_by_tid = {
+            ev["tid"]: ev["args"]["name"]
+            for ev in events
+            if ev.get("name") == "thread_name"
+        }
+        indexes = {
+            names_by_tid[ev["tid"]]: ev["args"]["sort_index"]
+            for ev in events
+            if ev.get("name") == "thread_sort_index"
+        }
+        self.assertEqual({"PoolWorker-1": 2, "Pool-1": 1, "Other": 0}, indexes)
+
+    def test_gc(self) -> None:
+        f = NonclosingBytesIO()
+        n = 0.0
+
+        def clock() -> float:
+            nonlocal n
+            n += 1.0
+            return n
+
+        t = TraceOutput(file=f, pid=4, clock=clock)
+        with t:
+            gc.collect()
+            # a stop with no start is ignored
+            t._gc_callback("stop", {"generation": 1})
+
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "gc"]
+        self.assertEqual(2, events[-1]["args"]["generation"])
+        self.assertEqual(0, events[-1]["tid"])
+        self.assertEqual(4, events[-1]["pid"])
+        self.assertEqual(1_000_000, events[-1]["dur"])
+
+    def test_no_gc_events(self) -> None:
+        f = NonclosingBytesIO()
+        callbacks = list(gc.callbacks)
+        with TraceOutput(file=f, gc_events=False):
+            self.assertEqual(callbacks, gc.callbacks)
+            gc.collect()
+        self.assertEqual(callbacks, gc.callbacks)
+
+        events = json.loads(f.getvalue())
+        self.assertEqual([{}], events)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_thread_info_after_fork(self) -> None:
+        keke._thread_info()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            ok = keke._thread_info()[0] == keke._get_tid()
+            os.write(w, b"1" if ok else b"0")
+            os._exit(0)
+        os.close(w)
+        try:
+            self.assertEqual(b"1", os.read(r, 1))
+        finally:
+            os.close(r)
+            os.waitpid(pid, 0)
+
+    def test_thread_renamed(self) -> None:
+        def work() -> None:
+            for name in ("Before", "After"):
+                threading.current_thread().name = name
+                f = NonclosingBytesIO()
+                with TraceOutput(file=f, gc_events=False):
+                    with kev("name_here", "cat_here"):
+                        pass
+                traces.append(json.loads(f.getvalue()))
+
+        traces: List[List[Dict[str, Any]]] = []
+        th = threading.Thread(target=work)
+        th.start()
+        th.join()
+
+        self.assertEqual(
+            ["Before", "After"], [events[0]["args"]["name"] for events in traces]
+        )
+
+    def test_kev_disabled(self) -> None:
+        with self.assertRaises(ValueError):
+            with kev("a"):
+                raise ValueError()
+
+    def test_kev_decorator(self) -> None:
+        # Decorated while tracing is off, but the tracer is looked up per call.
+        @kev("name_here", "cat_here", arg=1)
+        def func(a: int) -> int:
+            return a + 1
+
+        self.assertEqual("func", func.__name__)
+        self.assertEqual(1, func(0))
+
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            self.assertEqual(2, func(1))
+
+            @kev("other_name", "cat_here")
+            def func2() -> None:
+                pass
+
+            func2()
+            func2()
+
+        self.assertEqual(3, func(2))
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "cat_here"]
+        self.assertEqual(
+            ["name_here", "other_name", "other_name"], [ev["name"] for ev in events]
+        )
+        self.assertEqual({"arg": 1}, events[0]["args"])
+
+    def test_kev_entered_later(self) -> None:
+        before = kev("before", "cat_here")
+        f = NonclosingBytesIO()
+        t = TraceOutput(file=f, pid=4, clock=lambda: 10)
+        with t:
+            with before:
+                pass
+            during = kev("during", "cat_here")
+        with during:
+            pass
+
+        self.assertEqual(0, len(t.queue))
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "cat_here"]
+        self.assertEqual(["before"], [ev["name"] for ev in events])
+
     def test_ktrace(self) -> None:
         def func(a: Any, b: int = 1, c: int = 2) -> Any:
             return (a, b, c)
@@ -73,13 +344,19 @@ class TraceOutputTest(unittest.TestCase):
         tracer = ktrace("a[0]")(func)
         self.assertEqual((["foo", "bar"], 1, 2), tracer(["foo", "bar"]))
 
+        # max has no inspectable signature, which is only needed for trace args
+        self.assertEqual(2, ktrace()(max)(1, 2))
+        with self.assertRaises(ValueError):
+            ktrace("x")(max)
+
     def test_ktrace_capture(self) -> None:
-        f = NonclosingStringIO()
+        f = NonclosingBytesIO()
 
         def func(a: Any, b: int = 1, c: int = 2) -> Any:
             return (a, b, c)
 
-        with TraceOutput(file=f, pid=4, clock=lambda: 10):  # chosen by dice roll
+        # chosen by dice roll
+        with TraceOutput(file=f, pid=4, clock=lambda: 10, gc_events=False):
             tracer = ktrace("a[0]")(func)
             self.assertEqual((["foo", "bar"], 1, 2), tracer(["foo", "bar"]))
             self.assertEqual(([], 1, 2), tracer([]))
@@ -122,10 +399,119 @@ class TraceOutputTest(unittest.TestCase):
         self.assertEqual("dur", events[5]["cat"])
         self.assertEqual({"a[0]": "foo"}, events[5]["args"])
 
-    def test_bytes_raises_early(self) -> None:
-        buf = io.BytesIO()
-        with self.assertRaises(TypeError):
-            TraceOutput(file=buf)  # type: ignore
+    def test_ktrace_signatures(self) -> None:
+        f = NonclosingBytesIO()
+
+        def func(a: Any, e: int = 1, *args: Any, k: int = 2, **kwargs: Any) -> Any:
+            return (a, e, args, k, kwargs)
+
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            tracer = ktrace("a", "e", "args", "k", "kwargs", "z", "a[")(func)
+            self.assertEqual((0, 1, (), 2, {}), tracer(0))
+            self.assertEqual((0, 3, (4,), 5, {"x": 6}), tracer(0, 3, 4, k=5, x=6))
+            with self.assertRaises(TypeError):
+                tracer()  # type: ignore
+
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "dur"]
+        self.assertEqual(2, len(events))
+        self.assertEqual(
+            {
+                "a": "0",
+                "e": "1",
+                "args": "()",
+                "k": "2",
+                "kwargs": "{}",
+                "z": "NameError(\"name 'z' is not defined\")",
+                "a[": events[0]["args"]["a["],
+            },
+            events[0]["args"],
+        )
+        self.assertTrue(events[0]["args"]["a["].startswith("SyntaxError("))
+        self.assertEqual("(4,)", events[1]["args"]["args"])
+        self.assertEqual("{'x': 6}", events[1]["args"]["kwargs"])
+
+    def test_ktrace_positional_only(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            # A builtin, since 3.7 has no syntax for these.
+            tracer = ktrace("x", "y")(divmod)
+            self.assertEqual((3, 1), tracer(7, 2))
+
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "dur"]
+        self.assertEqual({"x": "7", "y": "2"}, events[0]["args"])
+
+    def test_not_writable_raises_early(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            with open(path, "w"):
+                pass
+            for mode in ("r", "rb"):
+                with open(path, mode) as f:
+                    with self.assertRaises(io.UnsupportedOperation):
+                        TraceOutput(file=f)
+
+    def test_binary_file(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            with open(path, "wb") as f:
+                with TraceOutput(file=f):
+                    with kev("caf\xe9", "cat_here"):
+                        pass
+                self.assertTrue(f.closed)
+
+            with open(path, "rb") as f:
+                events = json.loads(f.read().decode("utf-8"))
+            self.assertIn("caf\xe9", [ev.get("name") for ev in events])
+
+    def test_real_file(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            with open(path, "w") as f:
+                f.write("#")
+                with TraceOutput(file=f, close_output_file=False):
+                    with kev("name_here", "cat_here", arg=1):
+                        pass
+                f.write("#")
+                self.assertFalse(f.closed)
+
+            with open(path) as f:
+                data = f.read()
+            self.assertEqual("#", data[0])
+            self.assertEqual("#", data[-1])
+            json.loads(data[1:-1])
+
+            with open(path, "w") as f:
+                with TraceOutput(file=f):
+                    with kev("name_here", "cat_here", arg=1):
+                        pass
+                self.assertTrue(f.closed)
+
+            with open(path) as f:
+                json.load(f)
+
+    def test_non_utf8_file(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            with open(path, "w", encoding="cp1252") as f:
+                with TraceOutput(file=f, gc_events=False):
+                    with kev("中文", "cat_here", arg="é\U0001f600"):
+                        pass
+
+            with open(path, "rb") as fb:
+                data = fb.read()
+            data.decode("ascii")
+            events = json.loads(data)
+            self.assertEqual("中文", events[2]["name"])
+            self.assertEqual({"arg": "é\U0001f600"}, events[2]["args"])
+
+            with open(path, "w", encoding="utf-8") as f:
+                with TraceOutput(file=f, gc_events=False):
+                    with kev("中文", "cat_here"):
+                        pass
+
+            with open(path, encoding="utf-8") as f:
+                data_str = f.read()
+            self.assertEqual("中文", json.loads(data_str)[2]["name"])
 
     def test_no_close_output_file(self) -> None:
         buf = io.StringIO()
@@ -133,3 +519,144 @@ class TraceOutputTest(unittest.TestCase):
             with kev("name_here", "cat_here", arg=1):
                 pass
         json.loads(buf.getvalue())
+
+    def test_reentered_writer_idles(self) -> None:
+        buf = io.StringIO()
+        t = TraceOutput(file=buf, close_output_file=False, gc_events=False)
+        for _ in range(2):
+            with t:
+                start = time.process_time()
+                time.sleep(0.3)
+                cpu = time.process_time() - start
+            # The writer waits on the queue between batches, rather than spin.
+            self.assertLess(cpu, 0.1)
+
+    def test_many_events(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            for i in range(3000):
+                with kev("name_here", "cat_here", i=i):
+                    pass
+
+        events = [ev for ev in json.loads(f.getvalue()) if ev.get("cat") == "cat_here"]
+        self.assertEqual(list(range(3000)), [ev["args"]["i"] for ev in events])
+
+    def test_dropped_events(self) -> None:
+        f = NonclosingBytesIO()
+        t = TraceOutput(file=f, queue_size=0)
+        with t:
+            with kev("name_here", "cat_here"):
+                pass
+
+        # the X event (plus any gc)
+        self.assertGreaterEqual(t.dropped_events, 1)
+        events = json.loads(f.getvalue())
+        self.assertEqual(2, len(events))
+        self.assertEqual("dropped_events", events[0]["name"])
+        self.assertEqual("C", events[0]["ph"])
+        self.assertEqual({"value": t.dropped_events}, events[0]["args"])
+
+    def test_default_queue_size(self) -> None:
+        # Far more than the writer can keep up with, all at once.
+        f = NonclosingBytesIO()
+        t = TraceOutput(file=f, pid=4, clock=lambda: 10)
+        with t:
+            for i in range(100_000):
+                with kev("name_here", "cat_here", i=i):
+                    pass
+
+        self.assertEqual(0, t.dropped_events)
+        all_events = json.loads(f.getvalue())
+        events = [ev for ev in all_events if ev.get("cat") == "cat_here"]
+        self.assertEqual(100_000, len(events))
+        self.assertNotIn("dropped_events", [ev.get("name") for ev in all_events])
+
+    def test_odd_names_and_times(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: float("nan")):
+            with kev(123, "cat_here", arg=1):  # type: ignore
+                pass
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual(123, events[2]["name"])
+        self.assertEqual({"arg": 1}, events[2]["args"])
+        # NaN from the stdlib, null from orjson; either way it parses.
+        ts = events[2]["ts"]
+        self.assertTrue(ts is None or math.isnan(ts))
+
+    def test_unserializable_arg(self) -> None:
+        class Bad:
+            def __str__(self) -> str:
+                raise ValueError("no")
+
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            with kev("before", "cat_here", arg=1):
+                pass
+            with kev("bad", "cat_here", arg=Bad()):
+                pass
+            t = keke.get_tracer()
+            assert t is not None
+            t.put({"ph": "i", "name": "bad_dict", "args": {"arg": Bad()}}, False)
+            with kev("after", "cat_here", arg=2):
+                pass
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual(
+            ["before", "bad", "bad_dict", "after"], [ev["name"] for ev in events[2:-1]]
+        )
+        self.assertEqual({"arg": 1}, events[2]["args"])
+        self.assertEqual({"error": "ValueError('no')"}, events[3]["args"])
+        self.assertEqual(10_000_000, events[3]["ts"])
+        self.assertEqual({"error": "ValueError('no')"}, events[4]["args"])
+        self.assertEqual({"arg": 2}, events[5]["args"])
+
+    def test_stdlib_json(self) -> None:
+        f = NonclosingBytesIO()
+        encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+        with patch("keke._dumps", encode):
+            with TraceOutput(file=f, pid=4, clock=lambda: 10):
+                with kev("name_here", "cat_here", arg=1, **ODD_ARGS):
+                    pass
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual("name_here", events[2]["name"])
+        self.assertEqual({"arg": 1, **ODD_ARGS_JSON}, events[2]["args"])
+
+    @unittest.skipIf(keke._dumps is keke._stdlib_dumps, "needs orjson")
+    def test_orjson_fallbacks(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f, pid=4, clock=lambda: 10):
+            with kev("name_here", "cat_here", keys={1: 2, None: 3}, big=2**70):
+                pass
+            with kev("name_here", "cat_here", arg=1):
+                pass
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual({"keys": {"1": 2, "null": 3}, "big": 2**70}, events[2]["args"])
+        self.assertEqual({"arg": 1}, events[3]["args"])
+        self.assertEqual(keke._stdlib_dumps(ODD_ARGS), keke._orjson_dumps(ODD_ARGS))
+
+    def test_default_clock(self) -> None:
+        f = NonclosingBytesIO()
+        with TraceOutput(file=f):
+            t = keke.get_tracer()
+            assert t is not None
+            with kev("name_here", "cat_here"):
+                time.sleep(0.01)
+            kcount("count_here", 1)
+            # The public clock is still in seconds.
+            t.put({"ph": "i", "name": "put_here", "s": "g"}, False)
+            t.put(
+                {"ph": "i", "name": "ts_here", "s": "g", "ts": to_us(t.clock())}, False
+            )
+
+        events = load_nongc(f.getvalue())
+        self.assertEqual("name_here", events[2]["name"])
+        self.assertGreaterEqual(events[2]["dur"], 10_000)
+        self.assertLess(events[2]["dur"], 10_000_000)
+        self.assertEqual("count_here", events[3]["name"])
+        self.assertGreaterEqual(events[3]["ts"], events[2]["ts"] + events[2]["dur"])
+        self.assertEqual("ts_here", events[5]["name"])
+        self.assertGreaterEqual(events[5]["ts"], events[4]["ts"])
+        self.assertLess(events[5]["ts"], events[4]["ts"] + 1_000_000)